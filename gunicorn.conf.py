@@ -0,0 +1,12 @@
+"""
+NotePilot - gunicorn hooks (picked up automatically when gunicorn starts from the project root)
+"""
+import threading
+
+
+def post_worker_init(worker):
+    """Start loading the embedding model as soon as a worker has imported the app."""
+    # Loaded in the background so a first-time model download can't trip the worker
+    # timeout; requests that need the model wait on get_embedder's lock meanwhile
+    from app import get_embedder
+    threading.Thread(target=get_embedder, daemon=True).start()
@@ -0,0 +1,11 @@
+"""
+Page-range text extraction for parallel PDF parsing.
+Kept separate from app.py so worker processes only import PyMuPDF.
+"""
+import pymupdf
+
+
+def extract_page_range(pdf_path, start, stop):
+    """Extract text from pages [start, stop) of a PDF."""
+    with pymupdf.open(pdf_path, filetype="pdf") as doc:
+        return "\n".join(doc[i].get_text("text") for i in range(start, stop))
@@ -4,6 +4,7 @@ NotePilot - One-command run script
 import os
 import subprocess
 import sys
+import importlib.util
 
 def check_ollama():
     """Check if Ollama is running."""
@@ -36,9 +37,9 @@ def main():
     print("[2/3] Checking dependencies...")
     try:
         import flask
-        import PyPDF2
+        import pymupdf
+        import diskcache
         import sentence_transformers
-        import faiss
         print("✓ All dependencies installed")
     except ImportError as e:
         print(f"❌ Missing dependency: {e.name}")
@@ -61,8 +62,31 @@ def main():
     print("=" * 70)
     print()
     
-    from app import app
-    app.run(debug=False, host='0.0.0.0', port=5000)
+    if os.name == 'nt' or importlib.util.find_spec('gunicorn') is None:
+        # gunicorn is not available on Windows; fall back to the Flask server
+        from app import app, get_embedder
+        get_embedder()
+        app.run(debug=False, host='0.0.0.0', port=5000)
+    else:
+        # Each worker holds its own model and gets cores / workers embedding threads
+        # (rather than one thread per core each, cores^2 in total). A few workers with
+        # several threads each keeps a single large upload fast on an idle machine,
+        # while each worker's request threads still serve other users concurrently.
+        cpu_count = os.cpu_count() or 1
+        workers = max(1, min(4, cpu_count // 2))
+        threads_per_worker = str(max(1, cpu_count // workers))
+        env = dict(os.environ, EMBEDDING_THREADS=threads_per_worker, OMP_NUM_THREADS=threads_per_worker)
+        try:
+            subprocess.check_call([
+                sys.executable, '-m', 'gunicorn',
+                '-c', 'gunicorn.conf.py',
+                '-w', str(workers),
+                '-k', 'gthread', '--threads', '4',
+                '-b', '0.0.0.0:5000',
+                'app:app'
+            ], env=env)
+        except KeyboardInterrupt:
+            pass
 
 if __name__ == '__main__':
     main()
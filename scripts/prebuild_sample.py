@@ -0,0 +1,36 @@
+"""
+Prebuild the sample document served by /upload-sample.
+Runs the full pipeline (text extraction, chunking, embedding, Ollama summary) once and
+writes data/sample_ml_notes.npz and data/sample_ml_notes.summary.txt, so the sample
+loads without parsing, embedding or calling the LLM.
+
+Re-run after changing the sample PDF or the embedding model. Requires Ollama to be running.
+"""
+import sys
+import os
+
+# Run from the project root so app's relative paths resolve
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+os.chdir(ROOT_DIR)
+
+from app import process_pdf, save_cached_document, SAMPLE_PDF_PATH, SAMPLE_PREBUILT_PATH
+
+
+def main():
+    print(f"Processing {SAMPLE_PDF_PATH}...")
+    chunks, embeddings, summary, _ = process_pdf(SAMPLE_PDF_PATH)
+    if not summary.strip():
+        print("✗ Ollama returned an empty summary; not writing prebuilt sample")
+        return 1
+
+    if not save_cached_document(SAMPLE_PREBUILT_PATH, chunks, embeddings, summary):
+        print("✗ Could not write prebuilt sample")
+        return 1
+    
+    print(f"✓ Wrote {SAMPLE_PREBUILT_PATH}.npz ({len(chunks)} chunks) and {SAMPLE_PREBUILT_PATH}.summary.txt")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())